@@ -1,18 +1,34 @@
 import streamlit as st
-import json
+import orjson
 from utils.pdf_processing import process_pdf_pages
-from utils.llm_interaction import ask_question
+from utils.llm_interaction import ask_question, count_tokens, document_page_content, document_word_count
 from concurrent.futures import ThreadPoolExecutor, as_completed
 import logging
 import io
 from docx import Document
-import tiktoken
-
-# Function to count tokens
-def count_tokens(text, model="gpt-4o"):
-    encoding = tiktoken.encoding_for_model(model)
-    tokens = encoding.encode(text)
-    return len(tokens)
+import hashlib
+
+# Raised with the processed document when some of its pages failed, so st.cache_data does not keep it
+class IncompleteDocumentError(Exception):
+    def __init__(self, result):
+        super().__init__("Some pages could not be processed")
+        self.result = result
+
+# Check whether any page was marked as failed while it was processed
+def has_page_errors(document_data):
+    return any(page["failed"] for page in document_data["pages"])
+
+# Cache processed documents by content so identical uploads are not parsed again.
+# Tokens are counted here so the work happens in the worker thread, not the script thread.
+@st.cache_data(show_spinner=False, max_entries=32, ttl=3600, hash_funcs={bytes: lambda b: hashlib.blake2b(b).digest()})
+def cached_process_pdf_pages(file_bytes, file_name):
+    file_stream = io.BytesIO(file_bytes)
+    file_stream.name = file_name
+    document_data = process_pdf_pages(file_stream)
+    result = document_data, count_tokens(str(document_data))
+    if has_page_errors(document_data):
+        raise IncompleteDocumentError(result)
+    return result
 
 # Initialize session state
 if 'documents' not in st.session_state:
@@ -23,15 +39,38 @@ if 'uploaded_files' not in st.session_state:
     st.session_state.uploaded_files = []
 if 'doc_token' not in st.session_state:
     st.session_state.doc_token = 0
+if 'doc_tokens' not in st.session_state:
+    st.session_state.doc_tokens = {}
+if 'file_hashes' not in st.session_state:
+    st.session_state.file_hashes = {}
+if 'incomplete_files' not in st.session_state:
+    st.session_state.incomplete_files = {}
+if 'page_content' not in st.session_state:
+    st.session_state.page_content = {}
+if 'doc_word_counts' not in st.session_state:
+    st.session_state.doc_word_counts = {}
+
+# Pass the streamed answer through, ending it with an error note if the stream is cut off
+def stream_with_error_note(answer_stream):
+    try:
+        yield from answer_stream
+    except Exception:
+        yield "\n\nAn error occurred while processing your question."
 
 # Handle user question
 def handle_question(prompt):
     if prompt:
         try:
             with st.spinner('Thinking...'):
-                answer, tot_tokens = ask_question(
-                    st.session_state.documents, prompt, st.session_state.chat_history
+                answer_stream, tot_tokens = ask_question(
+                    st.session_state.documents, prompt, st.session_state.chat_history, stream=True,
+                    page_content=st.session_state.page_content, word_counts=st.session_state.doc_word_counts
                 )
+            # Show the answer while it is generated; the chat history renders the final version
+            answer_placeholder = st.empty()
+            with answer_placeholder.container():
+                answer = st.write_stream(stream_with_error_note(answer_stream))
+            answer_placeholder.empty()
             
             st.session_state.chat_history.append({
                 "question": prompt,
@@ -47,48 +86,46 @@ def reset_session():
     st.session_state.chat_history = []
     st.session_state.uploaded_files = []
     st.session_state.doc_token = 0
-
-# Function to display chat history
-def display_chat():
-    if st.session_state.chat_history:
-        for i, chat in enumerate(st.session_state.chat_history):
-            user_message = f"""
+    st.session_state.doc_tokens = {}
+    st.session_state.file_hashes = {}
+    st.session_state.incomplete_files = {}
+    st.session_state.page_content = {}
+    st.session_state.doc_word_counts = {}
+    st.session_state.upload_sig = ()
+
+# Generate the Word document for a chat turn once and reuse it on later reruns
+@st.cache_data(show_spinner=False, max_entries=32, ttl=3600)
+def generate_word_document(question, answer):
+    doc = Document()
+    doc.add_heading('Chat Response', 0)
+    doc.add_paragraph(f"Question: {question}")
+    doc.add_paragraph(f"Answer: {answer}")
+    word_io = io.BytesIO()
+    doc.save(word_io)
+    return word_io.getvalue()
+
+# HTML template for a single chat turn
+CHAT_MESSAGE_TEMPLATE = """
             <div style='padding:10px; border-radius:10px; margin:5px 0; text-align:right;'> 
-            {chat['question']}
+            {question}
             </div>
-            """
-            assistant_message = f"""
             <div style='padding:10px; border-radius:10px; margin:5px 0; text-align:left;'> 
-            {chat['answer']}
+            {answer}
             </div>
             """
-            st.markdown(user_message, unsafe_allow_html=True)
-            st.markdown(assistant_message, unsafe_allow_html=True)
-
-            # Prepare content for download
-            chat_content = {
-                "question": chat["question"],
-                "answer": chat["answer"]
-            }
-
-            # Generate Word document for download
-            def generate_word_document(content):
-                doc = Document()
-                doc.add_heading('Chat Response', 0)
-                doc.add_paragraph(f"Question: {content['question']}")
-                doc.add_paragraph(f"Answer: {content['answer']}")
-                return doc
-
-            # Generate the Word document in memory
-            doc = generate_word_document(chat_content)
-            word_io = io.BytesIO()
-            doc.save(word_io)
-            word_io.seek(0)
+
+# Function to display chat history
+def display_chat():
+    if st.session_state.chat_history:
+        for i, chat in enumerate(st.session_state.chat_history):
+            # Render the question and answer as a single element to halve the markdown calls
+            chat_message = CHAT_MESSAGE_TEMPLATE.format(question=chat['question'], answer=chat['answer'])
+            st.markdown(chat_message, unsafe_allow_html=True)
 
             # Provide a download button for the Word document
             st.download_button(
                 label="📥",
-                data=word_io,
+                data=generate_word_document(chat["question"], chat["answer"]),
                 file_name=f"chat_{i+1}.docx",
                 mime="application/vnd.openxmlformats-officedocument.wordprocessingml.document"
             )
@@ -102,11 +139,17 @@ with st.sidebar:
         help="Supports PDF, DOCX, XLSX, and PPTX formats.",
     )
 
-    if uploaded_files:
-        new_files = []
+    # Only rescan the uploads when the uploader contents changed since the last rerun; every upload gets a new file_id,
+    # so a file replaced by another with the same name and size is still noticed
+    upload_sig = tuple(f.file_id for f in uploaded_files or ())
+    if uploaded_files and upload_sig != st.session_state.get("upload_sig"):
+        all_processed = True
+        new_files = {}
         for index, uploaded_file in enumerate(uploaded_files):
-            if uploaded_file.name not in st.session_state.documents:
-                new_files.append(uploaded_file)
+            # Match uploads on content so renamed copies are not processed twice
+            file_hash = hashlib.blake2b(uploaded_file.getvalue(), digest_size=16).hexdigest()
+            if file_hash not in st.session_state.file_hashes:
+                new_files.setdefault(file_hash, uploaded_file)
             else:
                 st.info(f"{uploaded_file.name} is already uploaded.")
 
@@ -116,30 +159,68 @@ with st.sidebar:
             total_files = len(new_files)
 
             with st.spinner("Learning about your document(s)..."):
-                with ThreadPoolExecutor(max_workers=2) as executor:
+                # Processing is dominated by Azure round trips, so cap the files in flight rather than tying it to CPUs
+                with ThreadPoolExecutor(max_workers=min(len(new_files), 8)) as executor:
                     future_to_file = {
-                        executor.submit(process_pdf_pages, uploaded_file, first_file=(index == 0)): uploaded_file 
-                        for index, uploaded_file in enumerate(new_files)
+                        executor.submit(
+                            cached_process_pdf_pages, uploaded_file.getvalue(), uploaded_file.name
+                        ): (uploaded_file, file_hash)
+                        for file_hash, uploaded_file in new_files.items()
                     }
 
                     for i, future in enumerate(as_completed(future_to_file)):
-                        uploaded_file = future_to_file[future]
+                        uploaded_file, file_hash = future_to_file[future]
                         try:
-                            document_data = future.result()
-                            st.session_state.doc_token += count_tokens(str(document_data))
-                            st.session_state.documents[uploaded_file.name] = document_data
-                            st.success(f"{uploaded_file.name} processed successfully!")
+                            incomplete = False
+                            try:
+                                document_data, doc_tokens = future.result()
+                            except IncompleteDocumentError as e:
+                                # Keep what was processed; its hash is not recorded, so uploading the file again retries it instead of hitting the cache
+                                document_data, doc_tokens = e.result
+                                incomplete = True
+                                st.warning(f"Some pages of {uploaded_file.name} could not be processed.")
+                            # A retried incomplete document replaces its earlier result instead of being added next to it
+                            doc_name = st.session_state.incomplete_files.pop(file_hash, None)
+                            if doc_name is None:
+                                # A different file with the same name gets a distinct key instead of overwriting
+                                doc_name = uploaded_file.name
+                                if doc_name in st.session_state.documents:
+                                    doc_name = f"{uploaded_file.name} ({file_hash[:8]})"
+                            document_data["document_name"] = doc_name
+                            # Token counts are kept per document so only new files are tokenized
+                            st.session_state.doc_tokens[doc_name] = doc_tokens
+                            st.session_state.documents[doc_name] = document_data
+                            # Prompt sections are formatted once per document and kept with this session only
+                            st.session_state.page_content[doc_name] = document_page_content(doc_name, document_data)
+                            st.session_state.doc_word_counts[doc_name] = document_word_count(document_data)
+                            if incomplete:
+                                st.session_state.incomplete_files[file_hash] = doc_name
+                            else:
+                                st.session_state.file_hashes[file_hash] = doc_name
+                                st.success(f"{uploaded_file.name} processed successfully!")
                         except Exception as e:
+                            all_processed = False
                             st.error(f"Error processing {uploaded_file.name}: {e}")
 
                         progress_bar.progress((i + 1) / total_files)
 
+            # The total is derived from the per-document counts so the two can never drift apart
+            st.session_state.doc_token = sum(st.session_state.doc_tokens.values())
             st.sidebar.write(f"Total document tokens: {st.session_state.doc_token}")
             progress_text.text("Processing complete.")
             progress_bar.empty()
 
+        # A file that failed is retried on the next rerun rather than being skipped until the uploader changes
+        if all_processed:
+            st.session_state.upload_sig = upload_sig
+
     if st.session_state.documents:
-        download_data = json.dumps(st.session_state.documents, indent=4)
+        # Only re-serialize the analysis when the set of documents changed
+        download_sig = tuple(st.session_state.documents)
+        if st.session_state.get("download_sig") != download_sig:
+            st.session_state.download_data = orjson.dumps(st.session_state.documents, option=orjson.OPT_INDENT_2)
+            st.session_state.download_sig = download_sig
+        download_data = st.session_state.download_data
         st.download_button(
             label="Download Document Analysis",
             data=download_data,
@@ -1,358 +1,548 @@
-import requests
-from utils.config import azure_endpoint, api_key, api_version, model
-import logging
-import time
-import random
-import re
-import nltk
-from nltk.corpus import stopwords
-import tiktoken
-import concurrent.futures
-
-logging.basicConfig(level=logging.ERROR, format="%(asctime)s [%(levelname)s] %(message)s")
-nltk.download('stopwords', quiet=True)
-
-HEADERS = {
-        "Content-Type": "application/json",
-        "api-key": api_key
-    }
-
-def count_tokens(text, model="gpt-4o"):
-    """Count the tokens in a given text."""
-    encoding = tiktoken.encoding_for_model(model)
-    tokens = encoding.encode(text)
-    return len(tokens)
-
-
-
-
-def preprocess_text(text):
-    text = text.lower()
-    text = re.sub(r'[^\w\s]', '', text)
-    text = re.sub(r'\s+', ' ', text).strip()
-    stop_words = set(stopwords.words('english'))
-    text = ' '.join([word for word in text.split() if word not in stop_words])
-
-    return text
-
-
-
-def get_image_explanation(base64_image, retries=5, initial_delay=2):
-    headers = HEADERS
-    data = {
-        "model": model,
-        "messages": [
-            {"role": "system", "content": "You are a helpful assistant that responds in Markdown."},
-            {"role": "user", "content": [
-                {
-                    "type": "text",
-                    "text": "Explain the contents and figures or tables if present of this image of a document page. The explanation should be concise and semantically meaningful. Do not make assumptions about the specification and be accurate in your explanation."
-                },
-                {
-                    "type": "image_url",
-                    "image_url": {"url": f"data:image/png;base64,{base64_image}"}
-                }
-            ]}
-        ],
-        "temperature": 0.0
-    }
-
-    url = f"{azure_endpoint}/openai/deployments/{model}/chat/completions?api-version={api_version}"
-
-    
-    for attempt in range(retries):
-        try:
-            response = requests.post(url, headers=headers, json=data, timeout=30)  
-            response.raise_for_status()  
-            return response.json().get('choices', [{}])[0].get('message', {}).get('content', "No explanation provided.")
-        
-        except requests.exceptions.Timeout as e:
-            if attempt < retries - 1:
-                wait_time = initial_delay * (2 ** attempt)  
-                logging.warning(f"Timeout error. Retrying in {wait_time} seconds... (Attempt {attempt + 1}/{retries})")
-                time.sleep(wait_time)
-            else:
-                logging.error(f"Request failed after {retries} attempts due to timeout: {e}")
-                return f"Error: Request timed out after {retries} retries."
-
-        except requests.exceptions.RequestException as e:
-            logging.error(f"Error requesting image explanation: {e}")
-            return f"Error: Unable to fetch image explanation due to network issues or API error."
-
-    return "Error: Max retries reached without success."
-
-
-def generate_system_prompt(document_content):
-    headers = HEADERS
-    preprocessed_content = preprocess_text(document_content)
-    data = {
-        "model": model,
-        "messages": [
-            {"role": "system", "content": "You are a helpful assistant that serves the task given."},
-            {"role": "user", "content":
-             f"""You are provided with a document. Based on its content, extract and identify the following details:
-            Document_content: {preprocessed_content}
-
-            1. **Domain**: Identify the specific domain or field of expertise the document is focused on. Examples include technology, finance, healthcare, law, etc.
-            2. **Subject Matter**: Determine the main topic or focus of the document. This could be a detailed concept, theory, or subject within the domain.
-            3. **Experience**: Based on the content, infer the level of experience required to understand or analyze the document (e.g., novice, intermediate, expert).
-            4. **Expertise**: Identify any specialized knowledge, skills, or proficiency in a particular area that is necessary to evaluate the content.
-            5. **Educational Qualifications**: Infer the level of education or qualifications expected of someone who would need to review or write the document (e.g., PhD, Master's, Bachelor's, or certification in a field).
-            6. **Style**: Describe the writing style of the document. Is it formal, technical, conversational, academic, or instructional?
-            7. **Tone**: Identify the tone used in the document. For example, is it neutral, authoritative, persuasive, or informative?
-            8. **Voice**: Analyze whether the voice is active, passive, first-person, third-person, or impersonal, and whether it's personal or objective.
-
-            After extracting this information, use it to fill in the following template:
-    
-            ---
-
-            You are now assuming a persona based on the content of the provided document. Your persona should reflect the <domain> and <subject matter> of the content, with the requisite <experience>, <expertise>, and <educational qualifications> to analyze the document effectively. Additionally, you should adopt the <style>, <tone> and <voice> present in the document. Your expertise includes:
-    
-            <Domain>-Specific Expertise:
-            - In-depth knowledge and experience relevant to the <subject matter> of the document.
-            - Familiarity with the key concepts, terminology, and practices within the <domain>.
-            
-            Analytical Proficiency:
-            - Skilled in interpreting and evaluating the content, structure, and purpose of the document.
-            - Ability to assess the accuracy, clarity, and completeness of the information presented.
-    
-            Style, Tone, and Voice Adaptation:
-            - Adopt the writing <style>, <tone>, and <voice> used in the document to ensure consistency and coherence.
-            - Maintain the level of formality, technicality, or informality as appropriate to the document’s context.
-            
-            Your analysis should include:
-            - A thorough evaluation of the content, ensuring it aligns with <domain>-specific standards and practices.
-            - An assessment of the clarity and precision of the information and any accompanying diagrams or illustrations.
-            - Feedback on the strengths and potential areas for improvement in the document.
-            - A determination of whether the document meets its intended purpose and audience requirements.
-            - Proposals for any necessary amendments or enhancements to improve the document’s effectiveness and accuracy.
-        
-            ---
-
-            Generate a response filling the template with appropriate details based on the content of the document and return the filled in template as response."""}
-        ],
-        "temperature": 0.5  
-    }
-
-    try:
-        response = requests.post(
-            f"{azure_endpoint}/openai/deployments/{model}/chat/completions?api-version={api_version}",
-            headers=headers,
-            json=data,
-            timeout=20
-        )
-        response.raise_for_status()
-        prompt_response = response.json().get('choices', [{}])[0].get('message', {}).get('content', "")
-        return prompt_response.strip()
-
-    except requests.exceptions.RequestException as e:
-        logging.error(f"Error generating system prompt: {e}")
-        return f"Error: Unable to generate system prompt due to network issues or API error."
-
-
-def summarize_page(page_text, previous_summary, page_number, system_prompt, max_retries=5, base_delay=1, max_delay=32):
-    headers = HEADERS
-    preprocessed_page_text = preprocess_text(page_text)
-    preprocessed_previous_summary = preprocess_text(previous_summary)
-    
-    prompt_message = (
-        f"Please rewrite the following page content from (Page {page_number}) along with context from the previous page summary "
-        f"to make them concise and well-structured. Maintain proper listing and referencing of the contents if present."
-        f"Do not add any new information or make assumptions. Keep the meaning accurate and the language clear.\n\n"
-        f"Previous page summary: {preprocessed_previous_summary}\n\n"
-        f"Current page content:\n{preprocessed_page_text}\n"
-    )
-
-    data = {
-        "model": model,
-        "messages": [
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": prompt_message}
-        ],
-        "temperature": 0.0
-    }
-    
-    attempt = 0
-    while attempt < max_retries:
-        try:
-            response = requests.post(
-                f"{azure_endpoint}/openai/deployments/{model}/chat/completions?api-version={api_version}",
-                headers=headers,
-                json=data,
-                timeout=50
-            )
-            response.raise_for_status()
-            logging.info(f"Summary retrieved for page {page_number} at {time.strftime('%Y-%m-%d %H:%M:%S')}")
-            return response.json().get('choices', [{}])[0].get('message', {}).get('content', "No summary provided.").strip()
-        
-        except requests.exceptions.RequestException as e:
-            attempt += 1
-            if attempt >= max_retries:
-                logging.error(f"Error summarizing page {page_number}: {e}")
-                return f"Error: Unable to summarize page {page_number} due to network issues or API error."
-
-            
-            delay = min(max_delay, base_delay * (2 ** attempt))  
-            jitter = random.uniform(0, delay)  
-            logging.warning(f"Retrying in {jitter:.2f} seconds (attempt {attempt}) due to error: {e}")
-            time.sleep(jitter)
-
-
-def ask_question(documents, question, chat_history):
-    headers = HEADERS
-    preprocessed_question = preprocess_text(question)
-    
-    def calculate_token_count(text):
-        return len(text.split())  
-    
-    total_tokens = calculate_token_count(preprocessed_question)
-
-    # Calculate token count for all pages, removing the token limit check
-    for doc_name, doc_data in documents.items():
-        for page in doc_data["pages"]:
-            total_tokens += calculate_token_count(page.get('text_summary', 'No summary available'))
-            total_tokens += calculate_token_count(page.get('full_text', 'No full text available'))
-
-    # No token limit check, always run relevance checking
-    def check_page_relevance(doc_name, page):
-        page_summary = page.get('text_summary', 'No summary available') 
-        page_full_text = page.get('full_text', 'No full text available') 
-        image_explanation = "\n".join(
-            f"Page {img['page_number']}: {img['explanation']}" for img in page.get("image_analysis", [])
-        ) or "No image analysis."
-        
-        relevance_check_prompt = f"""
-        Here's the full text, summary and image analysis of a page:
-
-        Document: {doc_name}, Page {page['page_number']}
-        Full Text: {page_full_text}
-        Summary of the page: {page_summary}
-        Image Analysis: {image_explanation}
-
-        Question asked by user: {preprocessed_question}
-
-        Respond with "yes" if this page contains any relevant information related to the user's question, even if only a small part of the page has relevant content. Otherwise, respond with "no".
-        """
-
-        relevance_data = {
-            "model": model,
-            "messages": [
-                {"role": "system", "content": "You are an assistant that determines if a page is relevant to a question."},
-                {"role": "user", "content": relevance_check_prompt}
-            ],
-            "temperature": 0.0
-        }
-
-        try:
-            response = requests.post(
-                f"{azure_endpoint}/openai/deployments/{model}/chat/completions?api-version={api_version}",
-                headers=headers,
-                json=relevance_data,
-                timeout=60  
-            )
-            response.raise_for_status()
-            relevance_answer = response.json().get('choices', [{}])[0].get('message', {}).get('content', "no").strip().lower()
-
-            if relevance_answer == "yes":
-                return {
-                    "doc_name": doc_name,
-                    "page_number": page["page_number"],
-                    "text_summary": page_summary,
-                    "full_text": page_full_text,
-                    "image_explanation": image_explanation
-                }
-            return None  # Explicitly return None if relevance is "no"
-
-        except requests.exceptions.RequestException as e:
-            logging.error(f"Error checking relevance of page {page['page_number']} in '{doc_name}': {e}")
-            return None
-
-    relevant_pages = []
-    with concurrent.futures.ThreadPoolExecutor() as executor:
-        future_to_page = {
-            executor.submit(check_page_relevance, doc_name, page): (doc_name, page)
-            for doc_name, doc_data in documents.items()
-            for page in doc_data["pages"]
-        }
-
-        for future in concurrent.futures.as_completed(future_to_page):
-            result = future.result()
-            if result:
-                relevant_pages.append(result)
-
-    if not relevant_pages:
-        return "The content of the provided documents does not contain an answer to your question.", total_tokens
-
-    combined_relevant_content = ""
-    for page in relevant_pages:
-        combined_relevant_content += (
-            f"\nDocument: {page['doc_name']}, Page {page['page_number']}\n"
-            f"Full Text: {page['full_text']}\n"
-            f"Image Analysis: {page['image_explanation']}\n"
-        )
-
-    tok = count_tokens(combined_relevant_content)
-    if tok>120000:
-            combined_relevant_content = ""
-            for page in relevant_pages:
-                    combined_relevant_content += (
-            f"\nDocument: {page['doc_name']}, Page {page['page_number']}\n"
-            f"Page summary: {page['text_summary']}\n"
-            f"Image Analysis: {page['image_explanation']}\n"
-        )
-                    tok = count_tokens(combined_relevant_content)
-                    if tok>124000:
-                            logging.error(f"The relevant content exceeds the context of the LLM {tok}")
-    
-    conversation_history = "".join(
-        f"User: {preprocess_text(chat['question'])}\nAssistant: {preprocess_text(chat['answer'])}\n"
-        for chat in chat_history
-    )
-
-    prompt_message = (
-        f"""
-        You are given the following relevant content from multiple documents:
-
-        ---
-        {combined_relevant_content}
-        ---
-
-        Previous responses over the current chat session: {conversation_history}
-
-        Answer the following question based **strictly and only** on the factual information provided in the content above. 
-        Carefully verify all details from the content and do not generate any information that is not explicitly mentioned in it.
-        Ensure the response is clearly formatted for readability.
-
-        Include references to the document name and page number(s) where the information was found.
-
-        Question: {preprocessed_question}
-        """
-    )
-
-    prompt_tokens = count_tokens(prompt_message)
-    
-    final_data = {
-        "model": model,
-        "messages": [
-            {"role": "system", "content": "You are an assistant that answers questions based only on provided knowledge base."},
-            {"role": "user", "content": prompt_message}
-        ],
-        "temperature": 0.0
-    }
-
-    try:
-        response = requests.post(
-            f"{azure_endpoint}/openai/deployments/{model}/chat/completions?api-version={api_version}",
-            headers=headers,
-            json=final_data,
-            timeout=60  
-        )
-        response.raise_for_status()
-        return response.json().get('choices', [{}])[0].get('message', {}).get('content', "No answer provided.").strip(), prompt_tokens
-
-    except requests.exceptions.RequestException as e:
-        if e.response:
-            logging.error(f"Error {e.response.status_code} while answering question '{question}': {e}")
-        else:
-            logging.error(f"Error answering question '{question}': {e}")
-        return "An error occurred while processing your question.", total_tokens
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from utils.config import azure_endpoint, api_key, api_version, model
+import logging
+import time
+import random
+import re
+import orjson
+import nltk
+from nltk.corpus import stopwords
+import tiktoken
+import concurrent.futures
+import functools
+import hashlib
+import threading
+from binascii import b2a_base64
+
+logging.basicConfig(level=logging.ERROR, format="%(asctime)s [%(levelname)s] %(message)s")
+nltk.download('stopwords', quiet=True)
+
+# Relevance checks are I/O bound, so run more of them in flight than there are CPUs
+RELEVANCE_CHECK_WORKERS = 16
+
+# The deployment endpoint is fixed by the environment, so build it once
+CHAT_COMPLETIONS_URL = f"{azure_endpoint}/openai/deployments/{model}/chat/completions?api-version={api_version}"
+
+HEADERS = {
+        "Content-Type": "application/json",
+        "api-key": api_key
+    }
+
+# One pooled session for all Azure OpenAI calls so connections are kept alive instead of re-doing the TLS handshake
+SESSION = requests.Session()
+SESSION.mount("https://", HTTPAdapter(
+    pool_connections=32,
+    pool_maxsize=32,
+    max_retries=Retry(
+        total=5,
+        backoff_factor=0.5,
+        status_forcelist=[408, 429, 500, 502, 503, 504],
+        allowed_methods=frozenset(["POST"]),
+        respect_retry_after_header=True
+    )
+))
+
+# Bounded cache of LLM results keyed by a hash of their input, so repeated pages and images are not sent again
+LLM_CACHE_SIZE = 4096
+_llm_cache = {}
+_llm_cache_lock = threading.Lock()
+
+def content_hash(content):
+    """Return a short BLAKE2b digest of the given text or bytes."""
+    if isinstance(content, str):
+        content = content.encode("utf-8")
+    return hashlib.blake2b(content, digest_size=16).hexdigest()
+
+def llm_cache_get(key):
+    with _llm_cache_lock:
+        return _llm_cache.get(key)
+
+def llm_cache_set(key, value):
+    with _llm_cache_lock:
+        if len(_llm_cache) >= LLM_CACHE_SIZE:
+            _llm_cache.pop(next(iter(_llm_cache)))
+        _llm_cache[key] = value
+
+def chat_completion(data, timeout, default="", require_complete=False):
+    """Send a chat completion request through the shared session and return the first choice's content.
+
+    With require_complete, a reply cut off by the token limit raises ValueError instead of being returned.
+    """
+    response = SESSION.post(CHAT_COMPLETIONS_URL, headers=HEADERS, data=orjson.dumps(data), timeout=timeout)
+    response.raise_for_status()
+    choice = orjson.loads(response.content).get('choices', [{}])[0]
+    if require_complete and choice.get('finish_reason') == "length":
+        raise ValueError("Reply was truncated at the token limit")
+    # A content-filtered reply carries "content": null, so fall back to the default for that too
+    return choice.get('message', {}).get('content') or default
+
+@functools.lru_cache(maxsize=4)
+def _get_encoding(model):
+    """Load the tiktoken encoding for a model once and reuse it."""
+    return tiktoken.encoding_for_model(model)
+
+def count_tokens(text, model="gpt-4o"):
+    """Count the tokens in a given text."""
+    return len(_get_encoding(model).encode(text))
+
+
+
+
+# Loaded once; stopwords.words() re-reads the corpus file on every call
+STOP_WORDS = frozenset(stopwords.words('english'))
+PUNCTUATION_PATTERN = re.compile(r'[^\w\s]')
+
+def preprocess_text(text):
+    text = PUNCTUATION_PATTERN.sub('', text.lower())
+    # split() already collapses runs of whitespace, so no separate regex pass is needed
+    text = ' '.join([word for word in text.split() if word not in STOP_WORDS])
+
+    return text
+
+
+
+def get_image_explanation(image_bytes, mime_type="image/jpeg"):
+    """Explain an image of a document page, returning None when no explanation could be obtained."""
+    cache_key = ("image", model, content_hash(image_bytes))
+    cached_explanation = llm_cache_get(cache_key)
+    if cached_explanation is not None:
+        return cached_explanation
+
+    # Only encode on a cache miss, straight into the data URL
+    image_url = f"data:{mime_type};base64,{b2a_base64(image_bytes, newline=False).decode('ascii')}"
+    data = {
+        "model": model,
+        "messages": [
+            {"role": "system", "content": "You are a helpful assistant that responds in Markdown."},
+            {"role": "user", "content": [
+                {
+                    "type": "text",
+                    "text": "Explain the contents and figures or tables if present of this image of a document page. The explanation should be concise and semantically meaningful. Do not make assumptions about the specification and be accurate in your explanation."
+                },
+                {
+                    "type": "image_url",
+                    "image_url": {"url": image_url}
+                }
+            ]}
+        ],
+        "temperature": 0.0
+    }
+
+    # Timeouts, throttling and transient 5xx responses are retried by the session's adapter
+    try:
+        explanation = chat_completion(data, timeout=30).strip()
+        if not explanation:
+            logging.error("Error requesting image explanation: empty reply")
+            return None
+        llm_cache_set(cache_key, explanation)
+        return explanation
+
+    except (requests.exceptions.RequestException, ValueError) as e:
+        logging.error(f"Error requesting image explanation: {e}")
+        return None
+
+
+def generate_system_prompt(document_content):
+    preprocessed_content = preprocess_text(document_content)
+    data = {
+        "model": model,
+        "messages": [
+            {"role": "system", "content": "You are a helpful assistant that serves the task given."},
+            {"role": "user", "content":
+             f"""You are provided with a document. Based on its content, extract and identify the following details:
+            Document_content: {preprocessed_content}
+
+            1. **Domain**: Identify the specific domain or field of expertise the document is focused on. Examples include technology, finance, healthcare, law, etc.
+            2. **Subject Matter**: Determine the main topic or focus of the document. This could be a detailed concept, theory, or subject within the domain.
+            3. **Experience**: Based on the content, infer the level of experience required to understand or analyze the document (e.g., novice, intermediate, expert).
+            4. **Expertise**: Identify any specialized knowledge, skills, or proficiency in a particular area that is necessary to evaluate the content.
+            5. **Educational Qualifications**: Infer the level of education or qualifications expected of someone who would need to review or write the document (e.g., PhD, Master's, Bachelor's, or certification in a field).
+            6. **Style**: Describe the writing style of the document. Is it formal, technical, conversational, academic, or instructional?
+            7. **Tone**: Identify the tone used in the document. For example, is it neutral, authoritative, persuasive, or informative?
+            8. **Voice**: Analyze whether the voice is active, passive, first-person, third-person, or impersonal, and whether it's personal or objective.
+
+            After extracting this information, use it to fill in the following template:
+    
+            ---
+
+            You are now assuming a persona based on the content of the provided document. Your persona should reflect the <domain> and <subject matter> of the content, with the requisite <experience>, <expertise>, and <educational qualifications> to analyze the document effectively. Additionally, you should adopt the <style>, <tone> and <voice> present in the document. Your expertise includes:
+    
+            <Domain>-Specific Expertise:
+            - In-depth knowledge and experience relevant to the <subject matter> of the document.
+            - Familiarity with the key concepts, terminology, and practices within the <domain>.
+            
+            Analytical Proficiency:
+            - Skilled in interpreting and evaluating the content, structure, and purpose of the document.
+            - Ability to assess the accuracy, clarity, and completeness of the information presented.
+    
+            Style, Tone, and Voice Adaptation:
+            - Adopt the writing <style>, <tone>, and <voice> used in the document to ensure consistency and coherence.
+            - Maintain the level of formality, technicality, or informality as appropriate to the document’s context.
+            
+            Your analysis should include:
+            - A thorough evaluation of the content, ensuring it aligns with <domain>-specific standards and practices.
+            - An assessment of the clarity and precision of the information and any accompanying diagrams or illustrations.
+            - Feedback on the strengths and potential areas for improvement in the document.
+            - A determination of whether the document meets its intended purpose and audience requirements.
+            - Proposals for any necessary amendments or enhancements to improve the document’s effectiveness and accuracy.
+        
+            ---
+
+            Generate a response filling the template with appropriate details based on the content of the document and return the filled in template as response."""}
+        ],
+        "temperature": 0.0
+    }
+
+    try:
+        return chat_completion(data, timeout=20).strip()
+
+    except (requests.exceptions.RequestException, ValueError) as e:
+        logging.error(f"Error generating system prompt: {e}")
+        return f"Error: Unable to generate system prompt due to network issues or API error."
+
+
+def summarize_page(page_text, page_number, system_prompt, previous_page_text="", max_retries=5, base_delay=1, max_delay=32):
+    """Summarize a single page, returning None when no summary could be obtained."""
+    preprocessed_page_text = preprocess_text(page_text)
+    # Context comes from the raw text of the previous page, not its summary, so pages can be summarized independently
+    preprocessed_previous_page_text = preprocess_text(previous_page_text[:500])
+    
+    prompt_message = (
+        f"Please rewrite the following page content from (Page {page_number}) along with context from the start of the previous page "
+        f"to make them concise and well-structured. Maintain proper listing and referencing of the contents if present."
+        f"Do not add any new information or make assumptions. Keep the meaning accurate and the language clear.\n\n"
+        f"Start of previous page: {preprocessed_previous_page_text}\n\n"
+        f"Current page content:\n{preprocessed_page_text}\n"
+    )
+
+    data = {
+        "model": model,
+        "messages": [
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": prompt_message}
+        ],
+        "temperature": 0.0
+    }
+    
+    attempt = 0
+    while attempt < max_retries:
+        try:
+            summary = chat_completion(data, timeout=50).strip()
+            if not summary:
+                # An empty or content-filtered reply is a failure, not a summary worth keeping
+                logging.error(f"Error summarizing page {page_number}: empty reply")
+                return None
+            logging.info(f"Summary retrieved for page {page_number} at {time.strftime('%Y-%m-%d %H:%M:%S')}")
+            return summary
+
+        except requests.exceptions.RequestException as e:
+            # Transport errors were already retried by the session's adapter
+            logging.error(f"Error summarizing page {page_number}: {e}")
+            return None
+        
+        except ValueError as e:
+            # Only a reply that does not decode is worth asking for again
+            attempt += 1
+            if attempt >= max_retries:
+                logging.error(f"Error summarizing page {page_number}: {e}")
+                return None
+
+            
+            delay = min(max_delay, base_delay * (2 ** attempt))  
+            jitter = random.uniform(0, delay)  
+            logging.warning(f"Retrying in {jitter:.2f} seconds (attempt {attempt}) due to error: {e}")
+            time.sleep(jitter)
+
+
+def summarize_pages_batch(pages, system_prompt):
+    """Summarize several consecutive pages and return a {page_number: summary} dict, reusing cached summaries.
+
+    A page that could not be summarized maps to None.
+    """
+    summaries = {}
+    uncached_pages = []
+    for page_number, page_text in pages:
+        cached_summary = llm_cache_get(("summary", model, content_hash(page_text)))
+        if cached_summary is None:
+            uncached_pages.append((page_number, page_text))
+        else:
+            summaries[page_number] = cached_summary
+
+    if uncached_pages:
+        page_texts = dict(uncached_pages)
+        for page_number, summary in _summarize_pages_batch(uncached_pages, system_prompt).items():
+            summaries[page_number] = summary
+            if summary is not None:
+                llm_cache_set(("summary", model, content_hash(page_texts[page_number])), summary)
+
+    return summaries
+
+
+def _summarize_pages_batch(pages, system_prompt, max_retries=2, base_delay=1, max_delay=32):
+    """Summarize several consecutive pages in one request and return a {page_number: summary or None} dict."""
+    pages_json = orjson.dumps({str(page_number): preprocess_text(page_text) for page_number, page_text in pages}).decode("utf-8")
+
+    prompt_message = (
+        f"You are given the content of consecutive pages of a document as a JSON object mapping page numbers to page content. "
+        f"Please rewrite the content of each page, using the surrounding pages as context, "
+        f"to make them concise and well-structured. Maintain proper listing and referencing of the contents if present."
+        f"Do not add any new information or make assumptions. Keep the meaning accurate and the language clear.\n\n"
+        f"Respond with a JSON object that has the same page numbers as keys and the rewritten content of each page as values.\n\n"
+        f"Pages:\n{pages_json}\n"
+    )
+
+    data = {
+        "model": model,
+        "messages": [
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": prompt_message}
+        ],
+        "temperature": 0.0,
+        "response_format": {"type": "json_object"}
+    }
+
+    attempt = 0
+    while attempt < max_retries:
+        try:
+            summaries = orjson.loads(chat_completion(data, timeout=120, default="{}", require_complete=True))
+            if not isinstance(summaries, dict):
+                raise ValueError(f"Expected a JSON object of summaries, got {type(summaries).__name__}")
+            # JSON mode only guarantees valid JSON, so every page must come back as a non-empty string
+            missing_pages = [
+                page_number for page_number, _ in pages
+                if not isinstance(summaries.get(str(page_number)), str) or not summaries[str(page_number)].strip()
+            ]
+            if missing_pages:
+                raise ValueError(f"No summary returned for pages {missing_pages}")
+            logging.info(f"Summaries retrieved for pages {[page_number for page_number, _ in pages]} at {time.strftime('%Y-%m-%d %H:%M:%S')}")
+            return {page_number: summaries[str(page_number)].strip() for page_number, _ in pages}
+
+        except requests.exceptions.HTTPError as e:
+            # A 4xx (content filter, unsupported response_format) is about this request, so single pages may still go through
+            if e.response is not None and 400 <= e.response.status_code < 500:
+                logging.warning(f"Batch request for pages {[page_number for page_number, _ in pages]} was rejected, summarizing them one by one: {e}")
+                break
+            logging.error(f"Error summarizing pages {[page_number for page_number, _ in pages]}: {e}")
+            return {page_number: None for page_number, _ in pages}
+
+        except requests.exceptions.RequestException as e:
+            # Timeouts, connection errors and exhausted retries were already retried by the session's adapter, and page-by-page requests would hit the same failure
+            logging.error(f"Error summarizing pages {[page_number for page_number, _ in pages]}: {e}")
+            return {page_number: None for page_number, _ in pages}
+
+        except ValueError as e:
+            # A malformed or truncated reply is asked for once more before falling back to single pages; at temperature 0 further retries return the same output
+            attempt += 1
+            if attempt >= max_retries:
+                logging.error(f"Error summarizing pages {[page_number for page_number, _ in pages]}: {e}")
+                break
+
+            delay = min(max_delay, base_delay * (2 ** attempt))
+            jitter = random.uniform(0, delay)
+            logging.warning(f"Retrying in {jitter:.2f} seconds (attempt {attempt}) due to error: {e}")
+            time.sleep(jitter)
+
+    # Fall back to summarizing the pages one by one; they do not depend on each other, so run them together
+    page_numbers = [page_number for page_number, _ in pages]
+    page_texts = [page_text for _, page_text in pages]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(pages)) as executor:
+        page_summaries = executor.map(
+            summarize_page, page_texts, page_numbers, [system_prompt] * len(pages), [""] + page_texts[:-1]
+        )
+        return dict(zip(page_numbers, page_summaries))
+
+
+def document_word_count(doc_data):
+    """Count the words in a document's summaries and full text; callers keep the result with the document."""
+    return sum(
+        len(page.get('text_summary', 'No summary available').split())
+        + len(page.get('full_text', 'No full text available').split())
+        for page in doc_data["pages"]
+    )
+
+
+def document_page_content(doc_name, doc_data):
+    """Format each page's image analysis and answer-prompt sections; callers keep the result with the document."""
+    page_content = []
+    for page in doc_data["pages"]:
+        image_explanation = "\n".join(
+            f"Page {img['page_number']}: {img['explanation']}" for img in page.get("image_analysis", [])
+        ) or "No image analysis."
+        header = f"\nDocument: {doc_name}, Page {page['page_number']}\n"
+        page_content.append({
+            "image_explanation": image_explanation,
+            "full_content": f"{header}Full Text: {page.get('full_text', 'No full text available')}\nImage Analysis: {image_explanation}\n",
+            "summary_content": f"{header}Page summary: {page.get('text_summary', 'No summary available')}\nImage Analysis: {image_explanation}\n",
+        })
+    return page_content
+
+
+def stream_answer(data, question, timeout=60):
+    """Yield the answer text as the streamed chat completion arrives; errors are logged and re-raised so callers can tell a cut-off answer from a complete one."""
+    try:
+        with SESSION.post(
+            CHAT_COMPLETIONS_URL,
+            headers=HEADERS,
+            data=orjson.dumps({**data, "stream": True}),
+            timeout=timeout,
+            stream=True
+        ) as response:
+            response.raise_for_status()
+            for line in response.iter_lines():
+                # Server-sent events: each payload line looks like "data: {...}" and the stream ends with "data: [DONE]"
+                if not line.startswith(b"data: "):
+                    continue
+                payload = line[len(b"data: "):]
+                if payload == b"[DONE]":
+                    break
+                choices = orjson.loads(payload).get('choices') or []
+                if choices:
+                    content = choices[0].get('delta', {}).get('content')
+                    if content:
+                        yield content
+
+    except (requests.exceptions.RequestException, ValueError) as e:
+        logging.error(f"Error answering question '{question}': {e}")
+        raise
+
+
+def ask_question(documents, question, chat_history, stream=False, page_content=None, word_counts=None):
+    """Answer a question from the documents, using the precomputed document_page_content() and document_word_count() results when given. With stream=True the answer is returned as an iterator of text chunks."""
+    page_content = page_content or {}
+    word_counts = word_counts or {}
+    preprocessed_question = preprocess_text(question)
+    
+    total_tokens = len(preprocessed_question.split())
+
+    # Calculate token count for all pages, removing the token limit check
+    for doc_name, doc_data in documents.items():
+        total_tokens += word_counts[doc_name] if doc_name in word_counts else document_word_count(doc_data)
+
+    # No token limit check, always run relevance checking
+    def check_page_relevance(doc_name, page, page_sections):
+        page_summary = page.get('text_summary', 'No summary available') 
+        page_full_text = page.get('full_text', 'No full text available') 
+        image_explanation = page_sections["image_explanation"]
+        
+        relevance_check_prompt = f"""
+        Here's the full text, summary and image analysis of a page:
+
+        Document: {doc_name}, Page {page['page_number']}
+        Full Text: {page_full_text}
+        Summary of the page: {page_summary}
+        Image Analysis: {image_explanation}
+
+        Question asked by user: {preprocessed_question}
+
+        Respond with "yes" if this page contains any relevant information related to the user's question, even if only a small part of the page has relevant content. Otherwise, respond with "no".
+        """
+
+        relevance_data = {
+            "model": model,
+            "messages": [
+                {"role": "system", "content": "You are an assistant that determines if a page is relevant to a question."},
+                {"role": "user", "content": relevance_check_prompt}
+            ],
+            "temperature": 0.0
+        }
+
+        # The check runs at temperature 0, so the same page and question always get the same verdict
+        cache_key = ("relevance", model, content_hash(relevance_check_prompt))
+        relevance_answer = llm_cache_get(cache_key)
+        if relevance_answer is None:
+            try:
+                relevance_answer = chat_completion(relevance_data, timeout=60, default="no").strip().lower()
+                llm_cache_set(cache_key, relevance_answer)
+
+            except (requests.exceptions.RequestException, ValueError) as e:
+                logging.error(f"Error checking relevance of page {page['page_number']} in '{doc_name}': {e}")
+                return None
+
+        if relevance_answer == "yes":
+            return page_sections
+        return None  # Explicitly return None if relevance is "no"
+
+    pages_to_check = [
+        (doc_name, page, page_sections)
+        for doc_name, doc_data in sorted(documents.items())
+        for page, page_sections in zip(
+            doc_data["pages"], page_content.get(doc_name) or document_page_content(doc_name, doc_data)
+        )
+    ]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=RELEVANCE_CHECK_WORKERS) as executor:
+        # map() keeps document and page order, so the same inputs always build the same prompt prefix
+        relevant_pages = [result for result in executor.map(lambda args: check_page_relevance(*args), pages_to_check) if result]
+
+    if not relevant_pages:
+        no_answer = "The content of the provided documents does not contain an answer to your question."
+        return (iter([no_answer]) if stream else no_answer), total_tokens
+
+    # The per-page sections are formatted once per document, so each question only joins them
+    combined_relevant_content = "".join(page["full_content"] for page in relevant_pages)
+
+    tok = count_tokens(combined_relevant_content)
+    if tok>120000:
+            combined_relevant_content = "".join(page["summary_content"] for page in relevant_pages)
+            tok = count_tokens(combined_relevant_content)
+            if tok>124000:
+                    logging.error(f"The relevant content exceeds the context of the LLM {tok}, keeping only the pages that fit")
+                    # Trim to the context budget instead of sending a prompt the deployment will reject
+                    kept_content, tok = [], 0
+                    for page in relevant_pages:
+                        page_tokens = count_tokens(page["summary_content"])
+                        if tok + page_tokens > 124000:
+                            break
+                        kept_content.append(page["summary_content"])
+                        tok += page_tokens
+                    combined_relevant_content = "".join(kept_content)
+    
+    conversation_history = "".join(
+        f"User: {preprocess_text(chat['question'])}\nAssistant: {preprocess_text(chat['answer'])}\n"
+        for chat in chat_history
+    )
+
+    prompt_message = (
+        f"""
+        You are given the following relevant content from multiple documents:
+
+        ---
+        {combined_relevant_content}
+        ---
+
+        Previous responses over the current chat session: {conversation_history}
+
+        Answer the following question based **strictly and only** on the factual information provided in the content above. 
+        Carefully verify all details from the content and do not generate any information that is not explicitly mentioned in it.
+        Ensure the response is clearly formatted for readability.
+
+        Include references to the document name and page number(s) where the information was found.
+
+        Question: {preprocessed_question}
+        """
+    )
+
+    prompt_tokens = count_tokens(prompt_message)
+    
+    final_data = {
+        "model": model,
+        "messages": [
+            {"role": "system", "content": "You are an assistant that answers questions based only on provided knowledge base."},
+            {"role": "user", "content": prompt_message}
+        ],
+        "temperature": 0.0
+    }
+
+    if stream:
+        return stream_answer(final_data, question), prompt_tokens
+
+    try:
+        return chat_completion(final_data, timeout=60, default="No answer provided.").strip(), prompt_tokens
+
+    except (requests.exceptions.RequestException, ValueError) as e:
+        if getattr(e, "response", None):
+            logging.error(f"Error {e.response.status_code} while answering question '{question}': {e}")
+        else:
+            logging.error(f"Error answering question '{question}': {e}")
+        return "An error occurred while processing your question.", total_tokens
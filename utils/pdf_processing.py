@@ -1,151 +1,247 @@
-import fitz
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from utils.file_conversion import convert_office_to_pdf
-from utils.llm_interaction import summarize_page, get_image_explanation, generate_system_prompt
-import io
-import base64
-import logging
-import string
-import nltk
-from nltk.corpus import stopwords
-
-
-nltk.download('stopwords', quiet=True)
-stop_words = set(stopwords.words('english'))
-
-
-logging.basicConfig(level=logging.ERROR, format="%(asctime)s [%(levelname)s] %(message)s")
-generated_system_prompt = None
-
-def remove_stopwords_and_blanks(text):
-    """Preprocess text by removing stopwords, punctuation, and extra blank spaces."""
-    
-    text = text.translate(str.maketrans('', '', string.punctuation))
-    
-    
-    filtered_text = ' '.join([word for word in text.split() if word.lower() not in stop_words])
-    
-    
-    return ' '.join(filtered_text.split())
-
-def detect_ocr_images_and_vector_graphics_in_pdf(page, ocr_text_threshold=0.4):
-    """Detect OCR images or vector graphics on a given PDF page."""
-    try:
-        images = page.get_images(full=True)
-        text_blocks = page.get_text("blocks")
-        vector_graphics_detected = bool(page.get_drawings())
-
-        
-        page_area = page.rect.width * page.rect.height
-        text_area = sum((block[2] - block[0]) * (block[3] - block[1]) for block in text_blocks)
-        text_coverage = text_area / page_area if page_area > 0 else 0
-
-        pix = page.get_pixmap()
-        img_data = pix.tobytes("png")
-        base64_image = base64.b64encode(img_data).decode("utf-8")
-        pix = None  
-
-        if (images or vector_graphics_detected) and text_coverage < ocr_text_threshold:
-            return base64_image  
-
-    except Exception as e:
-        logging.error(f"Error detecting OCR images/graphics on page {page.number}: {e}")
-    
-    return None
-
-def process_page_batch(pdf_document, batch, system_prompt, ocr_text_threshold=0.4):
-    """Process a batch of PDF pages and extract summaries, full text, and image analysis."""
-    previous_summary = ""
-    batch_data = []
-
-    for page_number in batch:
-        try:
-            page = pdf_document.load_page(page_number)
-            text = page.get_text("text").strip()
-            summary = ""
-            
-            
-            if text != "":
-                summary = summarize_page(text, previous_summary, page_number + 1, system_prompt)
-                previous_summary = summary
-            
-            
-            image_data = detect_ocr_images_and_vector_graphics_in_pdf(page, ocr_text_threshold)
-            image_analysis = []
-            if image_data:
-                image_explanation = get_image_explanation(image_data)
-                image_analysis.append({"page_number": page_number + 1, "explanation": image_explanation})
-
-            
-            batch_data.append({
-                "page_number": page_number + 1,
-                "full_text": text,  
-                "text_summary": summary,  
-                "image_analysis": image_analysis
-            })
-
-        except Exception as e:
-            logging.error(f"Error processing page {page_number + 1}: {e}")
-            batch_data.append({
-                "page_number": page_number + 1,
-                "full_text": "",  
-                "text_summary": "Error in processing this page",
-                "image_analysis": []
-            })
-
-    return batch_data
-
-def process_pdf_pages(uploaded_file, first_file=False):
-    """Process the PDF pages in batches and extract summaries and image analysis."""
-    global generated_system_prompt
-    file_name = uploaded_file.name
-    
-    try:
-        
-        if file_name.lower().endswith('.pdf'):
-            pdf_stream = io.BytesIO(uploaded_file.read())  
-        else:
-            
-            pdf_stream = convert_office_to_pdf(uploaded_file)
-        
-        
-        pdf_document = fitz.open(stream=pdf_stream, filetype="pdf")
-        document_data = {"document_name": file_name, "pages": []}  
-        total_pages = len(pdf_document)
-        full_text = ""
-        
-        
-        if first_file and generated_system_prompt is None:
-            for page_number in range(total_pages):
-                page = pdf_document.load_page(page_number)
-                full_text += page.get_text("text").strip() + " "  
-                if len(full_text.split()) >= 200:
-                    break
-            
-            first_200_words = ' '.join(full_text.split()[:200])
-            generated_system_prompt = generate_system_prompt(first_200_words)
-
-        
-        batch_size = 5
-        page_batches = [range(i, min(i + batch_size, total_pages)) for i in range(0, total_pages, batch_size)]
-        
-        
-        with ThreadPoolExecutor() as executor:
-            future_to_batch = {executor.submit(process_page_batch, pdf_document, batch, generated_system_prompt): batch for batch in page_batches}
-            for future in as_completed(future_to_batch):
-                try:
-                    batch_data = future.result()  
-                    document_data["pages"].extend(batch_data)
-                except Exception as e:
-                    logging.error(f"Error processing batch: {e}")
-
-        
-        pdf_document.close()
-
-        
-        document_data["pages"].sort(key=lambda x: x["page_number"])
-        return document_data
-
-    except Exception as e:
-        logging.error(f"Error processing PDF file {file_name}: {e}")
-        raise ValueError(f"Unable to process the file {file_name}. Error: {e}")
+import fitz
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor, Future, as_completed
+from utils.file_conversion import convert_office_to_pdf
+from utils.llm_interaction import summarize_pages_batch, get_image_explanation, generate_system_prompt
+import logging
+import threading
+import os
+import string
+import nltk
+from nltk.corpus import stopwords
+
+
+nltk.download('stopwords', quiet=True)
+stop_words = set(stopwords.words('english'))
+
+
+logging.basicConfig(level=logging.ERROR, format="%(asctime)s [%(levelname)s] %(message)s")
+# Future for the system prompt shared by every upload; the first document to need one starts its generation
+generated_system_prompt = None
+system_prompt_lock = threading.Lock()
+
+# Upper bound on page batches in flight, to stay within the Azure OpenAI rate limit
+MAX_CONCURRENT_BATCHES = int(os.getenv("PAGE_WORKERS", "8"))
+
+# Shared by every upload so the worker threads stay warm and the cap holds across documents
+batch_executor = ThreadPoolExecutor(max_workers=MAX_CONCURRENT_BATCHES, thread_name_prefix="pdf-batch")
+
+# PyMuPDF is not thread-safe, so every call into it, across all documents being processed, is serialized
+fitz_lock = threading.Lock()
+
+# Render OCR snapshots at a fixed resolution instead of the page's native size
+OCR_IMAGE_DPI = 150
+
+# The vision model downsamples larger images anyway, so oversized pages are capped at this many pixels per side
+OCR_IMAGE_MAX_SIDE = 1536
+
+def remove_stopwords_and_blanks(text):
+    """Preprocess text by removing stopwords, punctuation, and extra blank spaces."""
+    
+    text = text.translate(str.maketrans('', '', string.punctuation))
+    
+    
+    # split() already drops blank runs, so the joined result needs no second pass
+    return ' '.join([word for word in text.split() if word.lower() not in stop_words])
+
+def has_vector_graphics(page):
+    """Check whether a page draws any vector paths, without building the full path list."""
+    return any(kind in ("fill-path", "stroke-path") for kind, _ in page.get_bboxlog())
+
+def detect_ocr_images_and_vector_graphics_in_pdf(page, ocr_text_threshold=0.4, text_blocks=None):
+    """Detect OCR images or vector graphics on a given PDF page and return (image_bytes, mime_type), or None."""
+    try:
+        if text_blocks is None:
+            text_blocks = page.get_text("blocks")
+
+        
+        page_area = page.rect.width * page.rect.height
+        text_area = 0.0
+        if text_blocks:
+            bboxes = np.asarray([block[:4] for block in text_blocks], dtype=np.float32)
+            text_area = float(((bboxes[:, 2] - bboxes[:, 0]) * (bboxes[:, 3] - bboxes[:, 1])).sum())
+        text_coverage = text_area / page_area if page_area > 0 else 0
+
+        # Cheap checks first: only pages that will actually be sent for image analysis get rasterized
+        if text_coverage >= ocr_text_threshold:
+            return None
+        # Only images the page actually draws; get_images() also lists unused ones from shared resources
+        images = page.get_image_info(xrefs=True)
+        drawings_detected = has_vector_graphics(page)
+        if not images and not drawings_detected:
+            return None
+
+        # A lone embedded photo or scan can be sent as stored, skipping the rasterize and re-encode; inline images have no xref
+        if len(images) == 1 and images[0]["xref"] and not drawings_detected:
+            image = page.parent.extract_image(images[0]["xref"])
+            if image and image["ext"] in ("jpeg", "png") and max(image["width"], image["height"]) <= OCR_IMAGE_MAX_SIDE:
+                return image["image"], f"image/{image['ext']}"
+
+        zoom = min(OCR_IMAGE_DPI / 72, OCR_IMAGE_MAX_SIDE / max(page.rect.width, page.rect.height, 1))
+        pix = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), alpha=False)
+        # JPEG is far smaller for scanned or photographic pages; pure line art stays lossless
+        if images:
+            img_data, mime_type = pix.tobytes("jpeg", jpg_quality=75), "image/jpeg"
+        else:
+            img_data, mime_type = pix.tobytes("png"), "image/png"
+        del pix  # Release the pixmap buffer right away rather than waiting for GC
+        return img_data, mime_type
+
+    except Exception as e:
+        logging.error(f"Error detecting OCR images/graphics on page {page.number}: {e}")
+    
+    return None
+
+def process_page_batch(pdf_document, batch, system_prompt, ocr_text_threshold=0.4):
+    """Process a batch of PDF pages and extract summaries, full text, and image analysis."""
+    batch_data = []
+    pages_to_summarize = []
+    pages_to_explain = []
+
+    for page_number in batch:
+        try:
+            with fitz_lock:
+                page = pdf_document[page_number]
+                # Extract the page once and derive both the plain text and the block layout from it
+                text_blocks = page.get_text("blocks")
+                text = "".join(block[4] for block in text_blocks if block[6] == 0).strip()
+                image_data = detect_ocr_images_and_vector_graphics_in_pdf(page, ocr_text_threshold, text_blocks)
+                del page  # Free the page object while the lock is still held
+            
+            
+            if text != "":
+                pages_to_summarize.append((page_number + 1, text))
+            
+            
+            page_data = {
+                "page_number": page_number + 1,
+                "full_text": text,  
+                "text_summary": "",  
+                "image_analysis": [],
+                "failed": False
+            }
+            if image_data:
+                pages_to_explain.append((page_data, image_data))
+            batch_data.append(page_data)
+
+        except Exception as e:
+            logging.error(f"Error processing page {page_number + 1}: {e}")
+            batch_data.append({
+                "page_number": page_number + 1,
+                "full_text": "",  
+                "text_summary": "Error in processing this page",
+                "image_analysis": [],
+                "failed": True
+            })
+
+    def summarize_batch():
+        # The system prompt may still be generating; only the summary request has to wait for it
+        prompt = system_prompt.result() if isinstance(system_prompt, Future) else system_prompt
+        return summarize_pages_batch(pages_to_summarize, prompt)
+
+    # Summarize the batch in a single request while the image explanations run alongside it
+    with ThreadPoolExecutor(max_workers=len(pages_to_explain) + 1) as executor:
+        summary_future = executor.submit(summarize_batch) if pages_to_summarize else None
+        future_to_page = {executor.submit(get_image_explanation, *image_data): page_data for page_data, image_data in pages_to_explain}
+
+        for future in as_completed(future_to_page):
+            page_data = future_to_page[future]
+            try:
+                explanation = future.result()
+            except Exception as e:
+                logging.error(f"Error explaining image on page {page_data['page_number']}: {e}")
+                explanation = None
+            if explanation is None:
+                explanation = "Error: Unable to fetch image explanation due to network issues or API error."
+                page_data["failed"] = True
+            page_data["image_analysis"].append({"page_number": page_data["page_number"], "explanation": explanation})
+
+        if summary_future is not None:
+            try:
+                summaries = summary_future.result()
+            except Exception as e:
+                # Keep the pages, their text and image analyses even when the summary request fails
+                logging.error(f"Error summarizing pages {[page_number for page_number, _ in pages_to_summarize]}: {e}")
+                summaries = {page_number: None for page_number, _ in pages_to_summarize}
+            for page_data in batch_data:
+                if page_data["page_number"] not in summaries:
+                    continue
+                summary = summaries[page_data["page_number"]]
+                if summary is None:
+                    summary = f"Error: Unable to summarize page {page_data['page_number']} due to network issues or API error."
+                    page_data["failed"] = True
+                page_data["text_summary"] = summary
+
+    return batch_data
+
+def process_pdf_pages(uploaded_file):
+    """Process the PDF pages in batches and extract summaries and image analysis."""
+    global generated_system_prompt
+    file_name = uploaded_file.name
+    
+    try:
+        
+        # Sniff the header rather than trusting the extension; the PDF spec allows junk before the %PDF- marker
+        header = uploaded_file.read(1024)
+        uploaded_file.seek(0)
+        if b"%PDF-" in header:
+            pdf_stream = uploaded_file.read()  # fitz reads the bytes directly, no extra copy
+        else:
+            
+            pdf_stream = convert_office_to_pdf(uploaded_file)
+        
+        
+        with fitz_lock:
+            pdf_document = fitz.open(stream=pdf_stream, filetype="pdf")
+            total_pages = len(pdf_document)
+        try:
+            document_data = {"document_name": file_name, "pages": []}  
+        
+        
+            # Concurrent uploads all take the same Future, so none of them sees a missing prompt while it is generated
+            with system_prompt_lock:
+                if generated_system_prompt is None:
+                    # Collect words rather than re-splitting an ever-growing string after every page
+                    words = []
+                    with fitz_lock:
+                        for page_number in range(total_pages):
+                            words.extend(pdf_document[page_number].get_text("text").split())
+                            if len(words) >= 200:
+                                break
+            
+                    first_200_words = ' '.join(words[:200])
+                    # Queued ahead of the batches, so it starts first while they extract text and explain images
+                    generated_system_prompt = batch_executor.submit(generate_system_prompt, first_200_words)
+                system_prompt = generated_system_prompt
+
+        
+            batch_size = 5
+            page_batches = [range(i, min(i + batch_size, total_pages)) for i in range(0, total_pages, batch_size)]
+        
+        
+            # Each batch writes into its own slot, so the pages come out in order without a sort
+            batch_results = [[] for _ in page_batches]
+            future_to_batch = {batch_executor.submit(process_page_batch, pdf_document, batch, system_prompt): index for index, batch in enumerate(page_batches)}
+            for future in as_completed(future_to_batch):
+                try:
+                    batch_results[future_to_batch[future]] = future.result()
+                except Exception as e:
+                    logging.error(f"Error processing batch: {e}")
+                    # Keep the pages in the document, marked as failed, rather than leaving a gap
+                    batch_results[future_to_batch[future]] = [
+                        {"page_number": page_number + 1, "full_text": "", "text_summary": "Error in processing this page", "image_analysis": [], "failed": True}
+                        for page_number in page_batches[future_to_batch[future]]
+                    ]
+            document_data["pages"] = [page_data for batch_data in batch_results for page_data in batch_data]
+
+        finally:
+            # Close the document even when processing fails, then let MuPDF release its object cache
+            with fitz_lock:
+                pdf_document.close()
+                fitz.TOOLS.store_shrink(100)
+
+        return document_data
+
+    except Exception as e:
+        logging.error(f"Error processing PDF file {file_name}: {e}")
+        raise ValueError(f"Unable to process the file {file_name}. Error: {e}")